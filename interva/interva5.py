@@ -7,26 +7,49 @@ interva.interva5
 This module contains the class for the InterVA5 algorithm.
 """
 from __future__ import annotations
-from typing import Union, TYPE_CHECKING
+from typing import Any, Union, TYPE_CHECKING
 if TYPE_CHECKING:
     import PyQt5
 from pandas import (DataFrame, Index, Series, read_csv, read_excel, to_numeric,
                     isna, set_option)
-from numpy import (ndarray, nan, nansum, nanmax, argsort, array, delete, where,
-                   concatenate, copy)
+from numpy import (ndarray, nan, nansum, nanmax, nanargmax, argmax, argsort,
+                   array, where, copy, divide, flatnonzero, frompyfunc, full,
+                   isin, newaxis, partition, rint, sort, take_along_axis,
+                   vstack, zeros)
 from decimal import Decimal
 from math import isclose
 from os import path, chdir, getcwd, mkdir
 from logging import INFO, FileHandler, getLogger
+from contextlib import nullcontext
 from csv import writer
+from functools import lru_cache
 import datetime
 from pkgutil import get_data
 from io import BytesIO
 
 from interva.data.causetext import CAUSETEXTV5
-from interva.utils import _get_dem_groups
+from interva.utils import _get_dem_groups, _get_top_csmf
 from vacheck.datacheck5 import datacheck5
 
+# numeric values of the likelihood levels used in the probbase
+PROBBASE_LEVELS = {"I": 1, "A+": 0.8, "A": 0.5, "A-": 0.2,
+                   "B+": 0.1, "B": 0.05, "B-": 0.02, "B -": 0.02,
+                   "C+": 0.01, "C": 0.005, "C-": 0.002,
+                   "D+": 0.001, "D": 5e-04, "D-": 1e-04,
+                   "E": 1e-05, "N": 0, "": 0}
+# the pregnancy status, cause and circumstances of mortality blocks of the
+# propensities, each normalized separately
+PROB_BLOCKS = (slice(0, 3), slice(3, 64), slice(64, 70))
+# pregnancy status by the most likely of the pregnancy propensities
+PREG_STATES = array(["Not pregnant or recently delivered",
+                     "Pregnancy ended within 6 weeks of death",
+                     "Pregnant at death"], dtype=object)
+# priors of HIV/AIDS related death (probbase column 22), and of malaria and
+# sickle cell with crisis (columns 24 and 44) for each indicator level
+HIV_PRIORS = {"h": 0.05, "l": 0.005, "v": 1e-05}
+MALARIA_PRIORS = {"h": (0.05, 0.05), "l": (0.005, 1e-05),
+                  "v": (1e-05, 1e-05)}
+
 
 class InterVA5:
     """InterVA5 algorithm for assigning cause of death.
@@ -176,30 +199,22 @@ class InterVA5:
                 str(comcat), comnum, wholeprob]
 
     @staticmethod
-    def _save_va5(x: list, filename: str, write: bool) -> None:
+    def _save_va5(x: list, csv_writer: Any) -> None:
         """ Saves the VA5 result to csv, without propensities. """
 
-        if not write:
+        if csv_writer is None:
             return ()
         del x[14]
-        filename = filename + ".csv"
-        with open(filename, 'a', newline="") as csvfile:
-            csv_writer = writer(csvfile)
-            csv_writer.writerow(x)
+        csv_writer.writerow(x)
 
     @staticmethod
-    def _save_va5_prob(x: list, filename: str, write: bool) -> None:
+    def _save_va5_prob(x: list, csv_writer: Any) -> None:
         """ Saves the VA5 result to csv, with propensities. """
 
-        if not write:
+        if csv_writer is None:
             return ()
         prob = x.pop(14)
-        x = array(x)
-        filename = filename + ".csv"
-        x = concatenate((x, prob))
-        with open(filename, "a", newline="") as csvfile:
-            csv_writer = writer(csvfile)
-            csv_writer.writerow(x)
+        csv_writer.writerow(x + prob.tolist())
 
     def run(self) -> None:
         """Assign causes of death to valid VA records.
@@ -233,10 +248,10 @@ class InterVA5:
         if global_dir != self.directory:
             chdir(self.directory)
 
-        probbaseV5 = None
         if self.sci is None:
-            probbase_df = get_probbase(version="19").copy()
-            probbaseV5 = probbase_df.to_numpy()
+            probbaseV5_version, probbaseV5, pb_for_datacheck = \
+                _prepare_default_probbase(version="19")
+            probbaseV5 = probbaseV5.copy()
         if self.sci is not None:
             valid_sci = True
             if not isinstance(self.sci, DataFrame) and \
@@ -251,13 +266,10 @@ class InterVA5:
             if isinstance(self.sci, DataFrame):
                 probbase_df = self.sci.copy()
                 self.sci = self.sci.to_numpy()
-            probbaseV5 = self.sci
+            probbaseV5_version, probbaseV5, pb_for_datacheck = \
+                _prepare_probbase(probbase_df)
 
-        pb_for_datacheck = probbase_df.fillna(".")
-        pb_for_datacheck["qdesc"] = ""
-        pb_for_datacheck = pb_for_datacheck.to_numpy(dtype=str)
-
-        self.probbaseV5Version = probbaseV5[0, 2]
+        self.probbaseV5Version = probbaseV5_version
         print(f"Using Probbase version: {self.probbaseV5Version}")
         causetextV5_horizontal = DataFrame(CAUSETEXTV5)
         self.causetextV5 = causetextV5_horizontal.transpose()
@@ -291,7 +303,7 @@ class InterVA5:
 
         va_data = self.va_input.copy()
         va_input_names = va_data.columns
-        id_inputs = va_data.iloc[:, 0]
+        id_inputs = va_data.iloc[:, 0].to_numpy()
         va_data = va_data.to_numpy()
         if va_data.shape[0] < 1:
             raise IOError("error: no data input")
@@ -302,9 +314,9 @@ class InterVA5:
                 "error: invalid data input format. Number of values incorrect")
         if va_input_names[S-1].lower() != "i459o":
             raise IOError("error: the last variable should be 'i459o'")
+        # only the header of the example input is needed for the labels
         va_data_csv = get_data("interva", "data/randomva5.csv")
-        randomVA5 = read_csv(BytesIO(va_data_csv))
-        valabels = randomVA5.columns
+        valabels = read_csv(BytesIO(va_data_csv), nrows=0).columns
         count_changelabel = 0
         for i in range(S):
             input_col = va_input_names[i]
@@ -319,275 +331,247 @@ class InterVA5:
                 "If the change is undesirable, please change in the input "
                 "to match standard InterVA5 input format.")
             va_input_names = valabels
-        pb_ncol = probbaseV5.shape[1]
-        probbaseV5[:, 17:pb_ncol][probbaseV5[:, 17:pb_ncol] == "I"] = 1
-        probbaseV5[:, 17:pb_ncol][probbaseV5[:, 17:pb_ncol] == "A+"] = 0.8
-        probbaseV5[:, 17:pb_ncol][probbaseV5[:, 17:pb_ncol] == "A"] = 0.5
-        probbaseV5[:, 17:pb_ncol][probbaseV5[:, 17:pb_ncol] == "A-"] = 0.2
-        probbaseV5[:, 17:pb_ncol][probbaseV5[:, 17:pb_ncol] == "B+"] = 0.1
-        probbaseV5[:, 17:pb_ncol][probbaseV5[:, 17:pb_ncol] == "B"] = 0.05
-        probbaseV5[:, 17:pb_ncol][probbaseV5[:, 17:pb_ncol] == "B-"] = 0.02
-        probbaseV5[:, 17:pb_ncol][probbaseV5[:, 17:pb_ncol] == "B -"] = 0.02
-        probbaseV5[:, 17:pb_ncol][probbaseV5[:, 17:pb_ncol] == "C+"] = 0.01
-        probbaseV5[:, 17:pb_ncol][probbaseV5[:, 17:pb_ncol] == "C"] = 0.005
-        probbaseV5[:, 17:pb_ncol][probbaseV5[:, 17:pb_ncol] == "C-"] = 0.002
-        probbaseV5[:, 17:pb_ncol][probbaseV5[:, 17:pb_ncol] == "D+"] = 0.001
-        probbaseV5[:, 17:pb_ncol][probbaseV5[:, 17:pb_ncol] == "D"] = 5e-04
-        probbaseV5[:, 17:pb_ncol][probbaseV5[:, 17:pb_ncol] == "D-"] = 1e-04
-        probbaseV5[:, 17:pb_ncol][probbaseV5[:, 17:pb_ncol] == "E"] = 1e-05
-        probbaseV5[:, 17:pb_ncol][probbaseV5[:, 17:pb_ncol] == "N"] = 0
-        probbaseV5[:, 17:pb_ncol][probbaseV5[:, 17:pb_ncol] == ""] = 0
-        probbaseV5[0, 0:17] = 0
         Sys_Prior = copy(to_numeric(probbaseV5[0, :]))
         D = len(Sys_Prior)
         self.hiv = self.hiv.lower()
         self.malaria = self.malaria.lower()
-        hlv_set = ["h", "l", "v"]
-        if self.hiv not in hlv_set or self.malaria not in hlv_set:
+        if self.hiv not in HIV_PRIORS or self.malaria not in MALARIA_PRIORS:
             raise IOError("error: the HIV and Malaria indicator "
                           "should be one of the three: 'h', 'l', 'v'")
-        if self.hiv == "h":
-            Sys_Prior[22] = 0.05
-        if self.hiv == "l":
-            Sys_Prior[22] = 0.005
-        if self.hiv == "v":
-            Sys_Prior[22] = 1e-05
-        if self.malaria == "h":
-            Sys_Prior[24] = 0.05
-            Sys_Prior[44] = 0.05
-        if self.malaria == "l":
-            Sys_Prior[24] = 0.005
-            Sys_Prior[44] = 1e-05
-        if self.malaria == "v":
-            Sys_Prior[24] = 1e-05
-            Sys_Prior[44] = 1e-05
+        Sys_Prior[22] = HIV_PRIORS[self.hiv]
+        Sys_Prior[24], Sys_Prior[44] = MALARIA_PRIORS[self.malaria]
+
+        # substantive value of each indicator and the numeric likelihoods of
+        # the causes for each indicator
+        subst_vector = full(S, nan)
+        subst_vector[probbaseV5[:, 5] == "N"] = 0
+        subst_vector[probbaseV5[:, 5] == "Y"] = 1
+        probbase_num = probbaseV5[:, 17:D].astype(float)
+        # priors of the causes, copied into each record's propensities
+        cause_prior = Sys_Prior[17:D].astype(float)
+        # names of all the causes, and of the causes and circumstances of
+        # mortality categories among them
+        prob_names = self.causetextV5.iloc[:, 0].copy()
+        cause_names = prob_names.iloc[3:64].to_numpy()
+        comcat_names = prob_names.iloc[64:70].to_numpy()
 
         ID_list = [nan for _ in range(N)]
-        VA_result = [[] for _ in range(N)]
-        if self.write and not self.append:
-            header = ["ID", "MALPREV", "HIVPREV", "PREGSTAT", "PREGLIK",
-                      "CAUSE1", "LIK1", "CAUSE2", "LIK2", "CAUSE3", "LIK3",
-                      "INDET", "COMCAT", "COMNUM"]
-            if self.output == "extended":
-                header = header + list(self.causetextV5.iloc[:, 0])
-            with open(self.filename + ".csv", "w", newline="") as write_obj:
-                csv_writer = writer(write_obj)
-                csv_writer.writerow(header)
-        nd = max(1, round(N/100))
-        np = max(1, round(N/10))
+        # one column of results per output field, left missing for the
+        # records that are excluded
+        va5_names = ["ID", "MALPREV", "HIVPREV", "PREGSTAT", "PREGLIK",
+                     "CAUSE1", "LIK1", "CAUSE2", "LIK2", "CAUSE3", "LIK3",
+                     "INDET", "COMCAT", "COMNUM", "WHOLEPROB"]
+        va5_columns = [full(N, nan, dtype=object) for _ in va5_names]
+        # propensities and reproductive age (0 or 1) of each record, -1 for
+        # the records that are excluded
+        propensities = zeros((N, D - 17))
+        reproductive_age = full(N, -1)
+        # recode the indicators as 0 (absence), 1 (presence), or nan (missing)
+        va_recoded = full(va_data.shape, nan, dtype=object)
+        va_recoded[isin(va_data, ["n", "N", "0"])] = 0
+        present = isin(va_data, ["y", "Y", "1"])
+        va_recoded[present] = 1
+        va_data = va_recoded
+        # records without an age group, a sex, or any symptom are excluded
+        has_age = present[:, 5:12].any(axis=1)
+        has_sex = present[:, 3:5].any(axis=1)
+        has_symptom = present[:, 20:328].any(axis=1)
+        # a dot is printed every 1% of the records, and the percentage
+        # every 10%, so the progress output does not grow with N
+        dot_stride = max(1, round(N/100))
+        pct_stride = max(1, round(N/10))
 
         if self.write:
             logger.info("\nThe following records are incomplete and "
                         "excluded from further processing:\n")
 
+        # log messages are collected and written in one call per section,
+        # rather than one handler write per message
+        excluded = []
         first_pass = []
         second_pass = []
         list_checked_data = []
         list_dem_group = []
 
+        # a break from the GUI stops the loop; the records processed so far
+        # are still written before run() raises
+        stopped = False
         for i in range(N):
             if self.gui_ctrl["break"]:
-                raise RuntimeError
+                stopped = True
+                break
             k = i + 1
-            if k % nd == 0:
+            if k % dot_stride == 0:
                 print(".", end="")
-            if k % np == 0:
+            if k % pct_stride == 0:
                 print(round(k/N * 100), "% completed", sep="")
             if k == N:
                 print("100% completed")
-            index_current = str(id_inputs.iloc[i])
-            va_data[i, :][va_data[i, :] == "n"] = "0"
-            va_data[i, :][va_data[i, :] == "N"] = "0"
-            va_data[i, :][va_data[i, :] == "y"] = "1"
-            va_data[i, :][va_data[i, :] == "Y"] = "1"
-            for j in range(va_data.shape[1]):
-                if va_data[i, j] != "0" and va_data[i, j] != "1":
-                    va_data[i, j] = nan
-
-            input_current = copy(va_data[i, :])
-            input_current[:][input_current[:] == "0"] = 0
-            input_current[:][input_current[:] == "1"] = 1
-
-            input_current[0] = 0
-            if nansum(input_current[5:12]) < 1:
-                if self.write:
-                    logger.info(index_current +
+            index_current = str(id_inputs[i])
+            if not has_age[i]:
+                excluded.append(index_current +
                                 " Error in age indicator: Not Specified")
                 if self.openva_app:
                     progress = int(100 * k / N)
                     self.openva_app.emit(progress)
                 continue
-            if nansum(input_current[3:5]) < 1:
-                if self.write:
-                    logger.info(index_current +
+            if not has_sex[i]:
+                excluded.append(index_current +
                                 " Error in sex indicator: Not Specified")
                 if self.openva_app:
                     progress = int(100 * k / N)
                     self.openva_app.emit(progress)
                 continue
-            if nansum(input_current[20:328]) < 1:
-                if self.write:
-                    logger.info(index_current +
+            if not has_symptom[i]:
+                excluded.append(index_current +
                                 " Error in indicators: No symptoms specified")
                 if self.openva_app:
                     progress = int(100 * k / N)
                     self.openva_app.emit(progress)
                 continue
 
-            input_current = Series(input_current, index=va_input_names)
+            input_current = copy(va_data[i, :])
+            input_current[0] = 0
+
+            # datacheck5 copies its input, so the record does not need to be
+            # copied into the Series
+            input_current = Series(input_current, index=va_input_names,
+                                   copy=False)
             tmp = datacheck5(va_input=input_current, va_id=index_current,
                              probbase=pb_for_datacheck)
 
             list_dem_group.append(_get_dem_groups(tmp["output"]))
 
+            # the checked record is not used after this, so work on its
+            # values in place
+            input_current = tmp["output"].to_numpy()
             if self.return_checked_data:
                 list_checked_data.append(
-                    [id_inputs[i]] + list(tmp["output"][1:S]))
+                    [id_inputs[i]] + input_current[1:S].tolist())
 
-            input_current = copy(tmp["output"])
             first_pass.append(tmp["first_pass"])
             second_pass.append(tmp["second_pass"])
 
-            subst_vector = array([nan for _ in range(S)])
-            subst_vector[probbaseV5[:, 5] == "N"] = 0
-            subst_vector[probbaseV5[:, 5] == "Y"] = 1
-
-            new_input = array([0 for _ in range(S)])
-            for y in range(1, S):
-                if not isna(input_current[y]):
-                    if input_current[y] == subst_vector[y]:
-                        new_input[y] = 1
+            # symptoms whose value matches the one in the probbase (missing
+            # values never match)
+            new_input = (input_current == subst_vector).astype(int)
+            new_input[0] = 0
 
             input_current[input_current == 0] = 1
             input_current[0] = 0
             input_current[isna(input_current)] = 0
-            reproductiveAge = 0
-            preg_state = " "
-            lik_preg = " "
-            if input_current[4] == 1 and (input_current[16:19].any() == 1):
-                reproductiveAge = 1
-            prob = copy(Sys_Prior[17:D])
+            reproductive_age[i] = (input_current[4] == 1 and
+                                   input_current[16:19].any() == 1)
+            prob = cause_prior.copy()
             temp = where(new_input[1:len(input_current)] == 1)[0]
-            for jj in range(len(temp)):
-                temp_sub = temp[jj]
-                for j in range(17, D):
-                    prob[j-17] = prob[j-17] * probbaseV5[temp_sub + 1, j]
-                if nansum(prob[0:3]) > 0:
-                    prob[0:3] = prob[0:3] / nansum(prob[0:3])
-                if nansum(prob[3:64]) > 0:
-                    prob[3:64] = prob[3:64] / nansum(prob[3:64])
-                if nansum(prob[64:70]) > 0:
-                    prob[64:70] = prob[64:70] / nansum(prob[64:70])
-
-            prob_names = self.causetextV5.iloc[:, 0].copy()
-            prob_A = copy(prob[0:3])
-            prob_B = copy(prob[3:64])
-            prob_C = copy(prob[64:70])
-
-            # Determine Preg_State and Likelihood
-            if nansum(prob_A) == 0 or reproductiveAge == 0:
-                preg_state = "n/a"
-                lik_preg = " "
-            if nanmax(prob_A) < 0.1 and reproductiveAge == 1:
-                preg_state = "indeterminate"
-                lik_preg = " "
-            if where(prob_A == nanmax(prob_A))[0][0] == 0 and \
-                    prob_A[0] >= 0.1 and reproductiveAge == 1:
-                preg_state = "Not pregnant or recently delivered"
-                lik_preg = round(prob_A[0]/nansum(prob_A) * 100)
-            if where(prob_A == nanmax(prob_A))[0][0] == 1 and \
-                    prob_A[1] >= 0.1 and reproductiveAge == 1:
-                preg_state = "Pregnancy ended within 6 weeks of death"
-                lik_preg = round(prob_A[1]/nansum(prob_A) * 100)
-            if where(prob_A == nanmax(prob_A))[0][0] == 2 and \
-                    prob_A[2] >= 0.1 and reproductiveAge == 1:
-                preg_state = "Pregnant at death"
-                lik_preg = round(prob_A[2]/nansum(prob_A) * 100)
-
-            # Determine the output of InterVA
-            prob_temp = copy(prob_B)
-            prob_temp_names = prob_names.iloc[3:64].copy()
-            top3 = []
-            cause1 = lik1 = cause2 = lik2 = cause3 = lik3 = None
-            indet = 0
-            if nanmax(prob_temp) < 0.4:
-                cause1 = lik1 = cause2 = lik2 = cause3 = lik3 = " "
-                indet = 100
-            if nanmax(prob_temp) >= 0.4:
-                max1_loc = where(prob_temp == nanmax(prob_temp))[0][0]
-                lik1 = round(nanmax(prob_temp) * 100)
-                cause1 = prob_temp_names.iloc[max1_loc]
-                prob_temp = delete(prob_temp, max1_loc)
-                prob_temp_names.drop(prob_temp_names.index
-                                     [max1_loc], inplace=True)
-                top3.append(lik1)
-
-                max2_loc = where(prob_temp == nanmax(prob_temp))[0][0]
-                lik2 = round(nanmax(prob_temp) * 100)
-                cause2 = prob_temp_names.iloc[max2_loc]
-                if nanmax(prob_temp) < 0.5 * nanmax(prob_B):
-                    lik2 = cause2 = " "
-                prob_temp = delete(prob_temp, max2_loc)
-                prob_temp_names.drop(prob_temp_names.index[max2_loc],
-                                     inplace=True)
-                top3.append(lik2)
-
-                max3_loc = where(prob_temp == nanmax(prob_temp))[0][0]
-                lik3 = round(nanmax(prob_temp) * 100)
-                cause3 = prob_temp_names.iloc[max3_loc]
-                if nanmax(prob_temp) < 0.5 * nanmax(prob_B):
-                    lik3 = cause3 = " "
-                top3.append(lik3)
-                top3 = array([int(x) if x != " " else 0 for x in top3])
-                indet = round(100 - nansum(top3))
-
-            # Determine the Circumstances of Mortality CATegory (COMCAT)
-            # and probability
-            prob_C_names = prob_names[64:70]
-            comcat = ""
-            comnum = None
-            if nansum(prob_C) > 0:
-                prob_C = prob_C / nansum(prob_C)
-            if nanmax(prob_C) < 0.5:
-                comcat = "Multiple"
-                comnum = " "
-            if nanmax(prob_C) >= 0.5:
-                comcat = prob_C_names[where(prob_C == nanmax(prob_C))[0][0]]
-                comnum = round(nanmax(prob_C) * 100)
+            # likelihoods of the causes for each of the symptoms present
+            symptom_probs = probbase_num[temp + 1]
+            # normalize after every symptom rather than once at the end: the
+            # cause assignments compare propensities exactly (e.g. against
+            # half of the top one), so the rounding must stay the same
+            for symptom_prob in symptom_probs:
+                prob *= symptom_prob
+                for block in PROB_BLOCKS:
+                    block_sum = nansum(prob[block])
+                    if block_sum > 0:
+                        prob[block] /= block_sum
 
             ID_list[i] = index_current
-            combined_prob = Series(concatenate((prob_A, prob_B, prob_C)),
-                                   index=prob_names)
-            VA_result[i] = InterVA5._va5(index_current, self.malaria, self.hiv,
-                                         preg_state, lik_preg, cause1, lik1,
-                                         cause2, lik2, cause3, lik3, indet,
-                                         comcat, comnum,
-                                         wholeprob=combined_prob)
-            if self.output == "classic":
-                InterVA5._save_va5(VA_result[i].copy(),
-                                   filename=self.filename,
-                                   write=self.write)
-            if self.output == "extended":
-                InterVA5._save_va5_prob(VA_result[i].copy(),
-                                        filename=self.filename,
-                                        write=self.write)
+            propensities[i] = prob
             if self.openva_app:
                 progress = int(100 * k / N)
                 self.openva_app.emit(progress)
+
+        # assign the pregnancy status, causes and circumstances of mortality
+        # category of all the processed records at once
+        scored = flatnonzero(reproductive_age >= 0)
+        prob_all = propensities[scored]
+        prob_A = prob_all[:, 0:3]
+        prob_B = prob_all[:, 3:64]
+        prob_C = prob_all[:, 64:70]
+        n_scored = len(scored)
+
+        # Determine Preg_State and Likelihood
+        reproductive = reproductive_age[scored] == 1
+        max_A = nanmax(prob_A, axis=1)
+        preg_loc = argmax(prob_A, axis=1)
+        preg_state = full(n_scored, "n/a", dtype=object)
+        lik_preg = full(n_scored, " ", dtype=object)
+        preg_state[reproductive & (max_A < 0.1)] = "indeterminate"
+        known = reproductive & (max_A >= 0.1)
+        preg_state[known] = PREG_STATES[preg_loc[known]]
+        lik_preg[known] = rint(max_A[known] / nansum(prob_A[known], axis=1)
+                               * 100).astype(int).tolist()
+
+        # Determine the output of InterVA
+        # top 3 causes (ties are taken in the order of the causes)
+        top3_loc = argsort(-prob_B, axis=1, kind="stable")[:, :3]
+        top3_prob = take_along_axis(prob_B, top3_loc, axis=1)
+        max_prob = top3_prob[:, 0:1]
+        top3_kept = (max_prob >= 0.4) & (top3_prob >= 0.5 * max_prob)
+        top3_lik = rint(top3_prob * 100).astype(int)
+        top3_names = full(top3_loc.shape, " ", dtype=object)
+        top3_names[top3_kept] = cause_names[top3_loc[top3_kept]]
+        top3_liks = full(top3_loc.shape, " ", dtype=object)
+        top3_liks[top3_kept] = top3_lik[top3_kept].tolist()
+        indet = (100 - (top3_lik * top3_kept).sum(axis=1)).tolist()
+
+        # Determine the Circumstances of Mortality CATegory (COMCAT)
+        # and probability
+        sum_C = nansum(prob_C, axis=1)[:, newaxis]
+        divide(prob_C, sum_C, out=prob_C, where=sum_C > 0)
+        max_C = nanmax(prob_C, axis=1)
+        comcat = where(max_C >= 0.5, comcat_names[nanargmax(prob_C, axis=1)],
+                       "Multiple")
+        comnum = full(n_scored, " ", dtype=object)
+        comnum[max_C >= 0.5] = rint(max_C[max_C >= 0.5] * 100).astype(
+            int).tolist()
+
+        # the output file is open only while the results are written
+        csv_file = nullcontext()
+        if self.write:
+            csv_file = open(self.filename + ".csv",
+                            "a" if self.append else "w", newline="")
+        with csv_file:
+            csv_writer = writer(csv_file) if self.write else None
+            if self.write and not self.append:
+                header = ["ID", "MALPREV", "HIVPREV", "PREGSTAT", "PREGLIK",
+                          "CAUSE1", "LIK1", "CAUSE2", "LIK2", "CAUSE3",
+                          "LIK3", "INDET", "COMCAT", "COMNUM"]
+                if self.output == "extended":
+                    header = header + list(self.causetextV5.iloc[:, 0])
+                csv_writer.writerow(header)
+            for j, i in enumerate(scored):
+                combined_prob = Series(prob_all[j], index=prob_names)
+                va5_row = InterVA5._va5(ID_list[i], self.malaria, self.hiv,
+                                        preg_state[j], lik_preg[j],
+                                        top3_names[j, 0], top3_liks[j, 0],
+                                        top3_names[j, 1], top3_liks[j, 1],
+                                        top3_names[j, 2], top3_liks[j, 2],
+                                        indet[j], comcat[j], comnum[j],
+                                        wholeprob=combined_prob)
+                for column, value in zip(va5_columns, va5_row):
+                    column[i] = value
+                if self.output == "classic":
+                    InterVA5._save_va5(va5_row, csv_writer)
+                if self.output == "extended":
+                    InterVA5._save_va5_prob(va5_row, csv_writer)
+        if stopped:
+            if self.write and excluded:
+                logger.info("\n".join(excluded))
+            raise RuntimeError
         if self.write:
+            if excluded:
+                logger.info("\n".join(excluded))
             logger.info("\nThe following data discrepancies were identified "
                         "and handled:\n")
-            for j in range(len(first_pass)):
-                item = first_pass[j]
-                if item:
-                    for k in item:
-                        logger.info(k)
+            first_pass = [k for item in first_pass if item for k in item]
+            if first_pass:
+                logger.info("\n".join(map(str, first_pass)))
             logger.info("\nSecond pass\n")
-            for j in range(len(second_pass)):
-                item = second_pass[j]
-                if item:
-                    for k in item:
-                        logger.info(k)
+            second_pass = [k for item in second_pass if item for k in item]
+            if second_pass:
+                logger.info("\n".join(map(str, second_pass)))
         chdir(global_dir)
         if not self.return_checked_data:
             self.checked_data = "return_checked_data = False"
@@ -596,16 +580,13 @@ class InterVA5:
             self.checked_data.columns = va_input_names
 
         ID_list = Series(ID_list, name="ID")
-        nan_indices = where(ID_list.isna())[0]
-        ID_list.drop(nan_indices, inplace=True)
+        processed = ID_list.notna().to_numpy()
+        ID_list = ID_list[processed]
 
         if len(ID_list) > 0:
-            VA_result = DataFrame(VA_result)
-            VA_result.columns = ["ID", "MALPREV", "HIVPREV", "PREGSTAT",
-                                 "PREGLIK", "CAUSE1", "LIK1", "CAUSE2", "LIK2",
-                                 "CAUSE3", "LIK3", "INDET", "COMCAT", "COMNUM",
-                                 "WHOLEPROB"]
-            VA_result.drop(nan_indices, axis=0, inplace=True)
+            VA_result = DataFrame(dict(zip(va5_names, va5_columns)),
+                                  copy=False).infer_objects()
+            VA_result = VA_result[processed]
         else:
             VA_result = None
 
@@ -759,26 +740,26 @@ class InterVA5:
                     this_undeter = sum(this_dist)
                 undeter = undeter + this_undeter
             else:
-                cutoff_3 = Decimal(this_dist[argsort(-this_dist)][2])
-                cutoff_2 = Decimal(this_dist[argsort(-this_dist)][1])
-                cutoff_1 = Decimal(this_dist[argsort(-this_dist)][0])
+                sorted_dist = -sort(partition(-this_dist, 2)[:3])
+                cutoff_3 = Decimal(sorted_dist[2])
+                cutoff_2 = Decimal(sorted_dist[1])
+                cutoff_1 = Decimal(sorted_dist[0])
                 cutoff_1_halved = cutoff_1 / Decimal('2')
                 cutoff_pt1 = cutoff_3.max(cutoff_1_halved)
                 cutoff_pt2 = cutoff_2.max(cutoff_1_halved)
                 cutoff = cutoff_pt1.min(cutoff_pt2)
                 adj_cutoff = cutoff - Decimal(1e-15)
 
-                undeter = undeter + sum(
-                    this_dist[where(this_dist < adj_cutoff)[0]])
-                this_dist[where(this_dist < adj_cutoff)[0]] = 0
+                below_cutoff = where(this_dist < adj_cutoff)[0]
+                undeter = undeter + sum(this_dist[below_cutoff])
+                this_dist[below_cutoff] = 0
 
-                temp_len = len(this_dist[where(this_dist > 0)[0]])
+                positive_indices = where(this_dist > 0)[0]
                 close_indices = []
-                for j in range(temp_len):
-                    val = Decimal(
-                        this_dist[where(this_dist > 0)[0]][j]) - cutoff
+                for j in positive_indices:
+                    val = Decimal(this_dist[j]) - cutoff
                     if abs(val) < 4e-29:
-                        close_indices.append(where(this_dist > 0)[0][j])
+                        close_indices.append(j)
 
                 close_indices.sort(reverse=True)
                 for k in close_indices:
@@ -808,20 +789,7 @@ class InterVA5:
 
         dist_cod_sorted = dist_cod.copy()
         dist_cod_sorted.sort_values(ascending=False, inplace=True)
-        # show causes with top non-zero values
-        show_top = 0
-        while dist_cod_sorted[show_top] > 0 and show_top < top:
-            show_top = show_top + 1
-        if show_top == top:
-            a = dist_cod_sorted[show_top]
-            b = dist_cod_sorted[show_top-1]
-            while show_top < len(dist_cod_sorted) and \
-                    (abs(a-b) < (a+b) * 1e-5):
-                show_top = show_top + 1
-                a = dist_cod_sorted[show_top]
-                b = dist_cod_sorted[show_top-1]
-        top_csmf = dist_cod_sorted.head(show_top)
-        return top_csmf
+        return _get_top_csmf(dist_cod_sorted, top)
 
     def write_csmf(self, top: int = 10, groupcode: bool = False,
                    filename: str = "csmf") -> None:
@@ -877,35 +845,30 @@ class InterVA5:
             prob_B = wholeprob.iloc[3:64].copy()
 
             if top == 0 or top is None:
-                cod_list[indiv] = prob_B
+                cod_list[indiv] = prob_B.to_numpy()
             if top > 0:
                 prob_temp = prob_B.to_numpy()
                 prob_temp_names = prob_B.index
+                # causes in order of decreasing propensity
+                cause_order = argsort(-prob_temp, kind="stable")
+                max_prob = nanmax(prob_temp)
+                cod_list[indiv] = []
                 for cause_num in range(top):
-                    if cause_num == 0:
-                        max_loc = where(prob_temp == nanmax(prob_temp))[0][0]
-                        cause = cod_list[indiv] = [prob_temp_names[max_loc]]
-                        if include_propensities:
-                            if cause == " ":
-                                cod_list[indiv].append(" ")
-                            else:
-                                cod_list[indiv].append(nanmax(prob_temp))
-                        prob_temp = delete(prob_temp, max_loc)
-                    if cause_num > 0:
-                        max_loc = where(prob_temp == nanmax(prob_temp))[0][0]
-                        cause = ""
-                        if nanmax(prob_temp) < 0.5 * nanmax(prob_B):
-                            cause = " "
+                    max_loc = cause_order[cause_num]
+                    if cause_num > 0 and prob_temp[max_loc] < 0.5 * max_prob:
+                        cause = " "
+                    else:
+                        cause = prob_temp_names[max_loc]
+                    cod_list[indiv].append(cause)
+                    if include_propensities:
+                        if cause == " ":
+                            cod_list[indiv].append(" ")
                         else:
-                            cause = prob_temp_names[max_loc]
-                        cod_list[indiv].append(cause)
-                        if include_propensities:
-                            if cause == " ":
-                                cod_list[indiv].append(" ")
-                            else:
-                                cod_list[indiv].append(nanmax(prob_temp))
-                        prob_temp = delete(prob_temp, max_loc)
-        cod_df = DataFrame(cod_list, columns=column_names)
+                            cod_list[indiv].append(prob_temp[max_loc])
+        if top == 0 or top is None:
+            cod_df = DataFrame(vstack(cod_list), columns=column_names)
+        else:
+            cod_df = DataFrame(cod_list, columns=column_names)
         cod_df.insert(loc=0, column='ID', value=self.results["ID"])
         return cod_df
 
@@ -957,6 +920,13 @@ def get_probbase(version: str = "19") -> DataFrame:
     :rtype: pandas.DataFrame
     """
 
+    return _read_probbase(version).copy()
+
+
+@lru_cache(maxsize=None)
+def _read_probbase(version: str) -> DataFrame:
+    """Parse the probbase bundled with the package (cached, do not modify)."""
+
     if version == "19":
         probbase_bytes = get_data(__name__, "data/probbaseV5_19.csv")
         probbase = read_csv(BytesIO(probbase_bytes))
@@ -968,3 +938,33 @@ def get_probbase(version: str = "19") -> DataFrame:
         probbase.drop([probbase.index[0]], inplace=True)
 
     return probbase
+
+
+def _prepare_probbase(probbase: DataFrame) -> tuple:
+    """
+    Prepare a probbase for run(): its version, its values with the levels
+    converted to probabilities, and its values as strings for the data
+    consistency checks.
+    """
+
+    pb_for_datacheck = probbase.fillna(".")
+    pb_for_datacheck["qdesc"] = ""
+    pb_for_datacheck = pb_for_datacheck.to_numpy(dtype=str)
+
+    # the values of an object frame can be a view, so convert a copy
+    probbase_values = probbase.to_numpy(copy=True)
+    version = probbase_values[0, 2]
+    pb_ncol = probbase_values.shape[1]
+    to_level_value = frompyfunc(lambda x: PROBBASE_LEVELS.get(x, x), 1, 1)
+    probbase_values[:, 17:pb_ncol] = to_level_value(
+        probbase_values[:, 17:pb_ncol])
+    probbase_values[0, 0:17] = 0
+
+    return version, probbase_values, pb_for_datacheck
+
+
+@lru_cache(maxsize=None)
+def _prepare_default_probbase(version: str) -> tuple:
+    """Prepare the bundled probbase for run() (cached, do not modify)."""
+
+    return _prepare_probbase(_read_probbase(version))
@@ -11,7 +11,8 @@ output from InterVA5 (i.e., the out attribute).
 from __future__ import annotations
 from typing import Union, TYPE_CHECKING
 from pandas import DataFrame, Index, Series, isna
-from numpy import append, argsort, delete, nanmax, where, zeros
+from numpy import (append, argsort, array, flatnonzero, newaxis, ones,
+                   partition, sort, vstack, where, zeros)
 from decimal import Decimal
 from math import isclose
 
@@ -167,13 +168,20 @@ def csmf(iva5: interva.interva5.InterVA5,
 
     va5_results = iva5.results["VA5"]
     if age is not None or sex is not None:
-        va5_results = _get_cod_with_dem(iva5)
+        # run() records the demographics in the order of the VA5 records,
+        # so select the group with boolean masks aligned by position (IDs
+        # need not be unique) instead of merging the demographics into a
+        # copy
+        dem_group = iva5.dem_group
+        if len(dem_group) != len(va5_results):
+            va5_results = _get_cod_with_dem(iva5)
+            dem_group = va5_results
+        dem_index = ones(len(va5_results), dtype=bool)
         if age is not None:
-            age_index = va5_results["age"] == age.lower()
-            va5_results = va5_results[age_index]
+            dem_index &= dem_group["age"].to_numpy() == age.lower()
         if sex is not None:
-            sex_index = va5_results["sex"] == sex.lower()
-            va5_results = va5_results[sex_index]
+            dem_index &= dem_group["sex"].to_numpy() == sex.lower()
+        va5_results = va5_results[dem_index]
 
     if va5_results.shape[0] == 0:
         raise ArgumentException("No VA results found.")
@@ -193,51 +201,67 @@ def csmf(iva5: interva.interva5.InterVA5,
 
     dist_cod.sort_values(ascending=False, inplace=True)
 
+    return _get_top_csmf(dist_cod, top)
+
+
+def _get_top_csmf(dist_cod: Series, top: int) -> Series:
+    """Return the top non-zero causes of a CSMF sorted in decreasing order.
+
+    Causes tied (within a relative tolerance) with the last of the top causes
+    are also included.
+
+    :param dist_cod: cause-specific mortality fractions sorted in decreasing
+    order.
+    :type dist_cod: pandas.Series
+    :param top: number of top causes in the CSMF to be determined.
+    :type top: int
+
+    :return: the top causes in CSMF with their values.
+    :rtype: pandas.Series
+    """
+
     # show causes with top non-zero values
+    n_causes = len(dist_cod)
     show_top = 0
-    while dist_cod[show_top] > 0 and show_top < top:
+    while show_top < min(top, n_causes) and dist_cod.iloc[show_top] > 0:
         show_top = show_top + 1
-    if show_top == top:
-        a = dist_cod[show_top]
-        b = dist_cod[show_top - 1]
-        while show_top < len(dist_cod) and (abs(a - b) < (a + b) * 1e-5):
+    # extend the top causes to include ties with the last one shown
+    if 0 < show_top == top:
+        while show_top < n_causes:
+            a = dist_cod.iloc[show_top]
+            b = dist_cod.iloc[show_top - 1]
+            if not abs(a - b) < (a + b) * 1e-5:
+                break
             show_top = show_top + 1
-            a = dist_cod[show_top]
-            b = dist_cod[show_top - 1]
-    top_csmf = dist_cod.head(show_top)
 
-    return top_csmf
+    return dist_cod.head(show_top)
 
 
-def _csmf_without_interva_rule(
-        va5: DataFrame,
-        top_aggregate: Union[bool, int] = None) -> Union[Series, None]:
-    """Return top causes in cause-specific mortality fraction (CSMF) without
-    applying the InterVA rule for only considering causes with propensities
-    above a threshold.
+def _get_cause_names(va5: DataFrame) -> tuple:
+    """Return the cause names and positions used in the CSMF.
+
+    The names are taken from the first record with a WHOLEPROB.  For the
+    standard input, the 3 pregnancy statuses and the 6 circumstances of
+    mortality categories are excluded.
 
     :param va5: The out["VA5"] attribute from InterVA5
     :type va5: pandas.DataFrame
-    :param top_aggregate: Integer indicating how many causes from the top need
-    to go into the summary.  The rest of the propensities are assigned into
-    the category "Undetermined".
-    :type top_aggregate: Union[int, None]
 
-    :return: cause-specific mortality fractions (CSMF) with causes as the
-    index.
-    :rtype: pandas.Series
+    :return: the cause names, their positions in WHOLEPROB, and a bool
+    indicating whether the pregnancy statuses and circumstances of mortality
+    need to be zeroed out of WHOLEPROB.
+    :rtype: tuple
     """
 
-    va = va5.copy()
-
     # for future compatibility with non-standard input
     cause_names = cause_index = []
-    for i in va.index:
-        if va.loc[i, "WHOLEPROB"] is not None:
-            cause_names = va.loc[i, "WHOLEPROB"].index
+    for i in va5.index:
+        if va5.loc[i, "WHOLEPROB"] is not None:
+            cause_names = va5.loc[i, "WHOLEPROB"].index
             cause_index = [x for x in range(len(cause_names))]
             break
     include_prob_ac = False
+
     # fix for removing the first 3 preg related death in standard input
     if ("Not pregnant or recently delivered" in cause_names[0] and
             "Pregnancy ended within 6 weeks of death" in cause_names[1] and
@@ -253,45 +277,69 @@ def _csmf_without_interva_rule(
         cause_names = cause_names.delete([0, 1, 2, 64, 65, 66, 67, 68, 69])
         include_prob_ac = True
 
+    return cause_names, cause_index, include_prob_ac
+
+
+def _csmf_without_interva_rule(
+        va5: DataFrame,
+        top_aggregate: Union[bool, int] = None) -> Union[Series, None]:
+    """Return top causes in cause-specific mortality fraction (CSMF) without
+    applying the InterVA rule for only considering causes with propensities
+    above a threshold.
+
+    :param va5: The out["VA5"] attribute from InterVA5
+    :type va5: pandas.DataFrame
+    :param top_aggregate: Integer indicating how many causes from the top need
+    to go into the summary.  The rest of the propensities are assigned into
+    the category "Undetermined".
+    :type top_aggregate: Union[int, None]
+
+    :return: cause-specific mortality fractions (CSMF) with causes as the
+    index.
+    :rtype: pandas.Series
+    """
+
+    va = va5.copy()
+
+    cause_names, cause_index, include_prob_ac = _get_cause_names(va)
+
     # Check if there is a valid va object
     if va.shape[0] < 1:
         print("No va5 object found")
         return None
 
-    # Initialize the population distribution
-    dist = None
-    for i in va.index:
-        if va.loc[i, "WHOLEPROB"] is not None:
-            dist = zeros(len(va.loc[i, "WHOLEPROB"]))
-            break
+    # Stack the propensities of all records into one matrix (one row per
+    # record); records without propensities are undetermined
+    has_prob = array([x is not None for x in va["WHOLEPROB"]], dtype=bool)
+    whole_probs = list(va["WHOLEPROB"][has_prob])
     if top_aggregate is None:
         top_aggregate = len(cause_index)
-    undetermined = 0
 
-    if dist is None:
+    if len(whole_probs) == 0:
         print("No va probability found in input")
         return None
 
+    all_dist = vstack([x.to_numpy() for x in whole_probs])
+    if include_prob_ac:
+        all_dist[:, 0:3] = 0
+        all_dist[:, 64:70] = 0
+    no_prob = all_dist.sum(axis=1) == 0
+    all_dist = all_dist[~no_prob]
+
     # Pick not simply the top # causes,
     # but the top # causes reported by InterVA5
-    for i in va.index:
-        whole_prob = va.loc[i, "WHOLEPROB"]
-        if whole_prob is None:
-            undetermined = undetermined + 1
-            continue
-        this_dist = whole_prob.copy()
-        this_dist = this_dist.to_numpy()
-        if include_prob_ac:
-            this_dist[0:3] = 0
-            this_dist[64:70] = 0
-        if sum(this_dist) == 0:
-            undetermined = undetermined + 1
-            continue
-        cutoff = this_dist[argsort(-this_dist)[top_aggregate - 1]]
-        undetermined = undetermined + sum(this_dist[this_dist < cutoff])
-        this_dist[this_dist < cutoff] = 0
-        if whole_prob is not None:
-            dist = dist + this_dist
+    cutoff = -partition(-all_dist, top_aggregate - 1,
+                        axis=1)[:, top_aggregate - 1]
+    below_cutoff = all_dist < cutoff[:, newaxis]
+    # the undetermined mass of each record (1 for the records without
+    # propensities), added up in record order with cumulative sums so that
+    # the rounding matches summing record by record
+    record_undetermined = ones(len(va))
+    record_undetermined[flatnonzero(has_prob)[~no_prob]] = where(
+        below_cutoff, all_dist, 0).cumsum(axis=1)[:, -1]
+    undetermined = record_undetermined.cumsum()[-1]
+    all_dist[below_cutoff] = 0
+    dist = all_dist.sum(axis=0)
     if undetermined > 0:
         dist_cod = append(dist[cause_index], undetermined)
         dist_cod = dist_cod / sum(dist_cod)
@@ -319,29 +367,7 @@ def _csmf_with_interva_rule(va5: DataFrame) -> Series:
 
     va = va5.copy()
 
-    # for future compatibility with non-standard input
-    cause_names = cause_index = []
-    for i in va.index:
-        if va.loc[i, "WHOLEPROB"] is not None:
-            cause_names = va.loc[i, "WHOLEPROB"].index
-            cause_index = [x for x in range(len(cause_names))]
-            break
-    include_prob_ac = False
-
-    # fix for removing the first 3 preg related death in standard input
-    if ("Not pregnant or recently delivered" in cause_names[0] and
-            "Pregnancy ended within 6 weeks of death" in cause_names[1] and
-            "Pregnant at death" in cause_names[2] and
-            "Culture" in cause_names[64] and
-            "Emergency" in cause_names[65] and
-            "Health" in cause_names[66] and
-            "Inevitable" in cause_names[67] and
-            "Knowledge" in cause_names[68] and
-            "Resources" in cause_names[69]):
-        del cause_index[64:70]
-        del cause_index[0:3]
-        cause_names = cause_names.delete([0, 1, 2, 64, 65, 66, 67, 68, 69])
-        include_prob_ac = True
+    cause_names, cause_index, include_prob_ac = _get_cause_names(va)
 
     # Check if there is a valid va object
     if va.shape[0] < 1:
@@ -373,26 +399,26 @@ def _csmf_with_interva_rule(va5: DataFrame) -> Series:
                 this_undetermined = sum(this_dist)
             undetermined = undetermined + this_undetermined
         else:
-            cutoff_3 = Decimal(this_dist[argsort(-this_dist)][2])
-            cutoff_2 = Decimal(this_dist[argsort(-this_dist)][1])
-            cutoff_1 = Decimal(this_dist[argsort(-this_dist)][0])
+            sorted_dist = -sort(partition(-this_dist, 2)[:3])
+            cutoff_3 = Decimal(sorted_dist[2])
+            cutoff_2 = Decimal(sorted_dist[1])
+            cutoff_1 = Decimal(sorted_dist[0])
             cutoff_1_halved = cutoff_1 / Decimal('2')
             cutoff_pt1 = cutoff_3.max(cutoff_1_halved)
             cutoff_pt2 = cutoff_2.max(cutoff_1_halved)
             cutoff = cutoff_pt1.min(cutoff_pt2)
             adj_cutoff = cutoff - Decimal(1e-15)
 
-            undetermined = undetermined + sum(
-                this_dist[where(this_dist < adj_cutoff)[0]])
-            this_dist[where(this_dist < adj_cutoff)[0]] = 0
+            below_cutoff = where(this_dist < adj_cutoff)[0]
+            undetermined = undetermined + sum(this_dist[below_cutoff])
+            this_dist[below_cutoff] = 0
 
-            temp_len = len(this_dist[where(this_dist > 0)[0]])
+            positive_indices = where(this_dist > 0)[0]
             close_indices = []
-            for j in range(temp_len):
-                val = Decimal(
-                    this_dist[where(this_dist > 0)[0]][j]) - cutoff
+            for j in positive_indices:
+                val = Decimal(this_dist[j]) - cutoff
                 if abs(val) < 4e-29:
-                    close_indices.append(where(this_dist > 0)[0][j])
+                    close_indices.append(j)
 
             close_indices.sort(reverse=True)
             for k in close_indices:
@@ -490,30 +516,20 @@ def get_indiv_cod(iva5: interva.interva5.InterVA5,
             prob_B = wholeprob.iloc[3:64].copy()
 
             if top == 0 or top is None:
-                cod_list[indiv] = prob_B
+                cod_list[indiv] = prob_B.to_numpy()
             if top > 0:
                 prob_temp = prob_B.to_numpy()
                 prob_temp_names = prob_B.index
-                for cause_num in range(top):
-                    if cause_num == 0:
-                        max_loc = where(prob_temp == nanmax(prob_temp))[0][0]
-                        cause = cod_list[indiv] = [prob_temp_names[max_loc]]
-                        if include_propensities:
-                            if cause == " ":
-                                cod_list[indiv].append(" ")
-                            else:
-                                cod_list[indiv].append(nanmax(prob_temp))
-                                prob_temp = delete(prob_temp, max_loc)
-                    if cause_num > 0:
-                        max_loc = where(prob_temp == nanmax(prob_temp))[0][0]
-                        cause = prob_temp_names[max_loc]
-                        cod_list[indiv].append(cause)
-                        if include_propensities:
-                            if cause == " ":
-                                cod_list[indiv].append(" ")
-                            else:
-                                cod_list[indiv].append(nanmax(prob_temp))
-                        prob_temp = delete(prob_temp, max_loc)
-        cod_df = DataFrame(cod_list, columns=column_names)
+                # causes in order of decreasing propensity
+                cause_order = argsort(-prob_temp, kind="stable")
+                cod_list[indiv] = []
+                for max_loc in cause_order[:top]:
+                    cod_list[indiv].append(prob_temp_names[max_loc])
+                    if include_propensities:
+                        cod_list[indiv].append(prob_temp[max_loc])
+        if top == 0 or top is None:
+            cod_df = DataFrame(vstack(cod_list), columns=column_names)
+        else:
+            cod_df = DataFrame(cod_list, columns=column_names)
         cod_df.insert(loc=0, column="ID", value=iva5.results["ID"])
         return cod_df
@@ -69,6 +69,45 @@ def test_run_correct_va_input(example_va_data):
     assert isinstance(iv5out.va_input, DataFrame)
 
 
+def test_run_does_not_modify_probbase(example_va_data):
+    iv5out = InterVA5(example_va_data, hiv="h", malaria="l", write=False,
+                      directory=".", output="extended")
+    iv5out.run()
+    probbase_csv = get_data("interva", "data/probbaseV5_19.csv")
+    probbase = read_csv(BytesIO(probbase_csv))
+    assert get_probbase().equals(probbase)
+    iv5out = InterVA5(example_va_data, hiv="h", malaria="l", write=False,
+                      directory=".", output="extended", sci=get_probbase())
+    iv5out.run()
+    assert iv5out.probbaseV5Version == probbase.iloc[0, 2]
+
+
+def test_run_break_writes_processed_records(example_va_data, tmp_path,
+                                            monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    gui_ctrl = {"break": False}
+
+    class StopAfter50:
+        n_emits = 0
+
+        def emit(self, progress):
+            self.n_emits += 1
+            if self.n_emits == 50:
+                gui_ctrl["break"] = True
+
+    iv5out = InterVA5(example_va_data, hiv="h", malaria="l", write=True,
+                      directory=str(tmp_path), filename="VA5_result",
+                      output="classic", openva_app=StopAfter50(),
+                      gui_ctrl=gui_ctrl)
+    with pytest.raises(RuntimeError):
+        iv5out.run()
+    with open(tmp_path / "VA5_result.csv") as results_file:
+        rows = results_file.readlines()
+    # header + the 50 records processed before the break
+    assert len(rows) == 51
+    assert rows[1].split(",")[0] == example_va_data.iloc[0, 0]
+
+
 def test_run_correct_id_output(example_va_data: DataFrame,
                                example_va_ids: Series):
     va_data = example_va_data
@@ -152,6 +191,7 @@ def test_run_correct_checked_data_output_if_true_return(example_va_data):
     checked_data_output = iv5out.results["checked_data"]
     assert isinstance(checked_data_output, DataFrame)
     assert (checked_data_output.columns == va_data.columns).all()
+    assert (checked_data_output["ID"] == va_data["ID"]).all()
 
 
 def test_run_correct_checked_data_output_if_false_return(example_va_data):
@@ -291,3 +331,20 @@ def test_write_indiv_prob_top_5(example_va_data):
         rowcount = rowcount + 1
     # account for column headers
     assert rowcount == len(iv5out.results["ID"]) + 1
+
+
+def test_get_indiv_prob_causes_match_propensities(example_va_data):
+    va_data = example_va_data
+    iv5out = InterVA5(va_data, hiv="h", malaria="l", write=False,
+                      directory=".", output="extended")
+    iv5out.run()
+    indiv_prob = iv5out.get_indiv_prob(top=3, include_propensities=True)
+    va5 = iv5out.results["VA5"]
+    for i in range(indiv_prob.shape[0]):
+        wholeprob = va5.loc[i, "WHOLEPROB"]
+        for k in range(1, 4):
+            cause = indiv_prob.loc[i, f"CAUSE{k}"]
+            if cause != " ":
+                assert indiv_prob.loc[i, f"PROPENSITY{k}"] == wholeprob[cause]
+        if va5.loc[i, "CAUSE2"] != " ":
+            assert indiv_prob.loc[i, "CAUSE2"] == va5.loc[i, "CAUSE2"]
@@ -133,3 +133,35 @@ def test_get_indiv_cod():
     assert out2.shape[1] == 6
     assert (out3["PROPENSITY5"] != " ").all()
     assert out3.shape[1] == 11
+
+
+def test_csmf_top_larger_than_causes():
+    out1 = csmf(iv5out, top=100, interva_rule=True)
+    out2 = csmf(iv5out, top=100, interva_rule=False)
+    out3 = iv5out.get_csmf(top=100)
+    assert 0 < len(out1) <= 62
+    assert 0 < len(out2) <= 62
+    assert 0 < len(out3) <= 62
+    assert len(csmf(iv5out, top=0)) == 0
+
+
+def test_get_indiv_cod_causes_match_propensities():
+    out = get_indiv_cod(iv5out, top=5, include_propensities=True,
+                        interva_rule=False)
+    va5 = iv5out.results["VA5"]
+    for i in range(out.shape[0]):
+        wholeprob = va5.loc[i, "WHOLEPROB"]
+        causes = [out.loc[i, f"CAUSE{k}"] for k in range(1, 6)]
+        assert len(set(causes)) == 5
+        for k in range(1, 6):
+            assert out.loc[i, f"PROPENSITY{k}"] == wholeprob[causes[k - 1]]
+
+
+def test_csmf_dem_group_with_duplicate_ids():
+    dup_data = va_data.copy()
+    dup_data.iloc[1, 0] = dup_data.iloc[0, 0]
+    dup_out = InterVA5(dup_data, hiv="h", malaria="l", write=False)
+    dup_out.run()
+    for dem in [{"sex": "male"}, {"age": "adult"},
+                {"age": "adult", "sex": "female"}]:
+        assert csmf(dup_out, **dem).equals(csmf(iv5out, **dem))